@@ -42,10 +42,15 @@ import shutil
 import sys
 import time
 import datetime
-import base64
-from hashlib import sha256 as shahex
-from functools import cmp_to_key
+from base64 import b64encode, b64decode
+import heapq
+import threading
+from collections import defaultdict
+from operator import attrgetter
+from functools import cmp_to_key, lru_cache
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 # pylint can't find this. it's fine to ignore.
 # pylint: disable=no-name-in-module
 from rpm import labelCompare as lc
@@ -63,6 +68,12 @@ FORMAT           = "%a, %d %b %Y %X GMT"
 ON_PAGE_FORMAT   = "%Y-%m-%d"
 
 DEF_TEMPLATE_DIR = '/usr/share/repoview3/templates'
+EZNAME_TABLE     = str.maketrans('/ ', '._')
+IO_BUFFER        = 1 << 20
+SOUT_BATCH       = 100
+RENDER_START     = 'forkserver'
+RENDER_BATCH     = 50
+J2_CACHE_SIZE    = 400
 
 def to_unicode(string: str) -> str:
     """
@@ -79,41 +90,31 @@ def to_base64(string: str) -> str:
     Converts a string to base64, but we put single quotes around it. This makes
     it easier to regex the value.
     """
-    string_bytes = string.encode('utf-8')
-    string_conv = base64.b64encode(string_bytes)
-    base64_str = "'" + string_conv.decode('utf-8') + "'"
-    return str(base64_str)
+    return "'" + b64encode(string.encode('utf-8')).decode('utf-8') + "'"
 
 def from_base64(string: str) -> str:
     """
     Takes a base64 value and returns a string. We also strip off any single
     quotes that can happen.
     """
-    stripped = string.replace("'", "")
-    conv_bytes = stripped.encode('utf-8')
-    convd_bytes = base64.b64decode(conv_bytes)
-    decoded = convd_bytes.decode('utf-8')
-    return decoded
+    return b64decode(string.replace("'", "")).decode('utf-8')
 
+@lru_cache(maxsize=4096)
 def human_size(numbytes: int):
     """
     Returns the size in units that makes sense (KiB or MiB).
     """
     if numbytes < 1024:
         return f'{numbytes} Bytes'
-    kilos = numbytes/1024
-    if kilos/1024 < 1:
-        return f'{kilos} KiB'
-    floater = float(kilos)/1024
-    return f'{floater} MiB'
+    if numbytes < 1 << 20:
+        return f'{numbytes / 1024:.1f} KiB'
+    return f'{numbytes / (1 << 20):.1f} MiB'
 
 def unique_first_chara(lst: list) -> list:
     """
     Returns a sorted unique list of the first characters of each list item
     """
-    uniques = list(set(pk[0] for pk in lst))
-    uniques.sort()
-    return uniques
+    return sorted({pk[0] for pk in lst})
 
 def stamper(stamp):
     """
@@ -131,17 +132,84 @@ def ezname(text):
     """
     Make a web friendly name out of whatever text is thrown here
     """
-    text = text.replace('/', '.')
-    text = text.replace(' ', '_')
-    return text
+    return text.translate(EZNAME_TABLE)
 
-def uniqlist(lst):
+@lru_cache(maxsize=None)
+def get_j2env(template_dir: str):
     """
-    Takes a list and makes items unique
+    Returns the jinja2 environment for a template directory. The environment
+    is only built once per directory so compiled templates are shared.
     """
-    new_list = list(dict.fromkeys(lst))
-    new_list.sort()
-    return new_list
+    environment = j2env(
+            autoescape=True,
+            trim_blocks=True,
+            cache_size=J2_CACHE_SIZE,
+            loader=j2fsl(template_dir)
+    )
+    environment.filters['stamper'] = stamper
+    environment.filters['timer'] = timer
+    return environment
+
+@lru_cache(maxsize=None)
+def get_template(template_dir: str, name: str):
+    """
+    Returns a compiled template from the environment of a template directory
+    """
+    return get_j2env(template_dir).get_template(name)
+
+def write_stream(path: str, stream):
+    """
+    Writes a template stream out to a file as utf-8 as it is rendered
+    """
+    with open(path, 'wb', buffering=IO_BUFFER) as of:
+        stream.dump(of, encoding='utf-8')
+
+@lru_cache(maxsize=None)
+def evr_ranks(evrs: frozenset) -> dict:
+    """
+    Returns a dict of each unique (epoch, version, release) tuple to its rank
+    in rpm version order. Each unique evr is only compared against the others
+    once, rather than on every comparison of a full sort. Subpackages built
+    from the same source rpm share their evrs, so the ranking is cached.
+    evrs that rpm considers equal (e.g. 1.0 and 1.00) share a rank, so a
+    stable sort on the rank keeps their original order.
+    """
+    ranks = {}
+    rank = 0
+    previous = None
+    for evr in sorted(evrs, key=cmp_to_key(lc)):
+        if previous is not None and lc(previous, evr) != 0:
+            rank += 1
+        ranks[evr] = rank
+        previous = evr
+    return ranks
+
+def write_group(template_dir: str, outprefix: str, repo_data, group_data):
+    """
+    Renders and writes out a group page. This runs in a worker process, so
+    everything passed in must be plain data and not dnf objects. outprefix is
+    the output directory ending in a path separator, as every page is a bare
+    filename.
+    """
+    group_template = get_template(template_dir, TEMPLATE_GRP)
+    write_stream(outprefix + group_data['filename'], group_template.stream(
+        repo_data=repo_data,
+        group_data=group_data
+    ))
+
+def write_packages(template_dir: str, outprefix: str, repo_data, group_data, pkg_pages):
+    """
+    Renders and writes out a batch of package pages of a group. Like
+    write_group, this runs in a worker process.
+    """
+    package_template = get_template(template_dir, TEMPLATE_PKG)
+    for pkg_data in pkg_pages:
+        output_file = outprefix + pkg_data['filename']
+        write_stream(output_file, package_template.stream(
+            repo_data=repo_data,
+            group_data=group_data,
+            pkg_data=pkg_data
+        ))
 
 class DnfQuiet(dnf.Base):
     """
@@ -199,10 +267,7 @@ class DnfQuiet(dnf.Base):
         """
         Return most recent packages from dnf sack
         """
-        recent = []
-        now = time.time()
-        recentlimit = now-(days*86400)
-        ftimehash = {}
+        recentlimit = time.time()-(days*86400)
         if self.conf.showdupesfromrepos:
             available = self.sack.query().available().filter()
         else:
@@ -210,18 +275,7 @@ class DnfQuiet(dnf.Base):
 
         available.run()
 
-        for package in available:
-            ftime = int(package.buildtime)
-            if ftime > recentlimit:
-                if ftime not in ftimehash:
-                    ftimehash[ftime] = [package]
-                else:
-                    ftimehash[ftime].append(package)
-
-        for sometime in ftimehash.keys():
-            for package in ftimehash[sometime]:
-                recent.append(package)
-
+        recent = [pkg for pkg in available if int(pkg.buildtime) > recentlimit]
         return recent
 
 # pylint: disable=too-many-instance-attributes
@@ -250,14 +304,31 @@ class RepoView:
         self.dnf_config      = options.config
         self.recents         = options.recents
 
-        # template things
-        self.j2loader = j2fsl(options.template_dir)
-        self.j2env    = j2env(autoescape=True, trim_blocks=True, loader=self.j2loader)
-        self.j2env.filters['stamper'] = stamper
-        self.j2env.filters['timer'] = timer
-        self.group_template = self.j2env.get_template(TEMPLATE_GRP)
-        self.package_template = self.j2env.get_template(TEMPLATE_PKG)
-        self.index_template = self.j2env.get_template(TEMPLATE_INDEX)
+        # io things
+        self._io_pool        = ThreadPoolExecutor(max_workers=1)
+        self._builddir       = os.fspath(self.outdir).rstrip(os.sep) + '.new'
+        self._olddir         = os.fspath(self.outdir).rstrip(os.sep) + '.old'
+        self._sout_buf       = []
+        self._sout_lock      = threading.RLock()
+        self._outprefix      = os.path.join(self._builddir, '')
+
+        # packages are shared between comps and letter groups, so their data
+        # is only gathered once. package pages are only written from the
+        # letter groups, which hold every package exactly once and come last,
+        # so a package's data is dropped once its page is handed off.
+        self._pkg_cache = {}
+
+        # template things. the group and package templates are rendered by
+        # worker processes, but are loaded here so broken templates are found
+        # before dnf is loaded.
+        get_template(options.template_dir, TEMPLATE_GRP)
+        get_template(options.template_dir, TEMPLATE_PKG)
+        self.index_template = get_template(options.template_dir, TEMPLATE_INDEX)
+
+        # Pages are built into a fresh directory next to the output directory,
+        # prepared in the background while dnf loads its metadata. The
+        # published output is only replaced once everything is written.
+        self._setup_future = self._io_pool.submit(self.setup_output)
 
         # Actually do dnf stuff right here
         dnfobj = DnfQuiet()
@@ -312,24 +383,25 @@ class RepoView:
         self.sout('Obtaining environment information')
         self.environments = dnfobj.get_environments()
 
-        self.setup_output()
-
         # package things
         self.sout('Obtaining all package information')
-        self.sack_query = dnfobj.sack.query().available()
-        all_pkgs = self.sack_query.filter()
-        self.sout('Sorting packages by name')
-        self.named_pkgs = sorted(set(all_pkgs), key=lambda pkg: pkg.name)
-        self.sout('Sorting packages by build time')
-        sorted_pkgs = sorted(set(all_pkgs), key=lambda pkg: pkg.buildtime)
-        sorted_pkgs.reverse()
+        sack_query = dnfobj.sack.query().available()
+        all_pkgs = list(dict.fromkeys(sack_query.filter()))
+        self.pkgs_by_name = defaultdict(list)
+        for pkg in all_pkgs:
+            self.pkgs_by_name[pkg.name].append(pkg)
+        self._pkg_filename = {name: ezname(FILE_PKG % name) for name in self.pkgs_by_name}
         self.sout('Getting unique first character list')
-        package_names = list(set(pkg.name for pkg in sorted_pkgs))
+        package_names = list(self.pkgs_by_name)
         letters = unique_first_chara(package_names)
+        self.letter_buckets = defaultdict(list)
+        for pkg_name in package_names:
+            self.letter_buckets[pkg_name[0]].append(pkg_name)
         self.sout('Getting letter group package lists')
         self.letter_groups = self.get_letter_group_data(letters)
         self.sout(f'Getting {self.recents} of the latest packages')
-        self.latest = self.proc_latest(sorted_pkgs[:self.recents])
+        latest_pkgs = heapq.nlargest(self.recents, all_pkgs, key=attrgetter('buildtime'))
+        self.latest = self.proc_latest(latest_pkgs)
 
         self.repo_filler = {
                 'title': self.title,
@@ -342,25 +414,39 @@ class RepoView:
         self.proc_groups()
 
         self.sout('Writing index')
-        output_file = os.path.join(self.outdir, 'index.html')
-        with open(output_file, "w+") as of:
-            of.write(self.index_template.render(
-                repo_data=self.repo_filler,
-                url=self.link,
-                latest=self.latest,
-                groups=self.groups,
-                time=time.strftime(ON_PAGE_FORMAT)
-            ))
-            of.close()
+        output_file = self._outprefix + FILE_INDEX
+        write_stream(output_file, self.index_template.stream(
+            repo_data=self.repo_filler,
+            url=self.link,
+            latest=self.latest,
+            groups=self.groups,
+            time=time.strftime(ON_PAGE_FORMAT)
+        ))
+
+        self.sout('Publishing output')
+        self.publish_output()
+
+        self._io_pool.shutdown()
+        self.flush_sout()
 
     def proc_groups(self):
         """
-        Process group data
+        Process group data. Group pages and batches of package pages are
+        rendered by a pool of worker processes.
         """
         self.sout('Processing group data')
-        counter = 0
-        for group_filler in self.groups + self.letter_groups:
-            (group_name, group_description, group_file, pkg_list) = group_filler
+        self._setup_future.result()
+        # the workers are started from a fresh server process rather than
+        # forked from this one, which is multi-threaded by now
+        render_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context(RENDER_START)
+        )
+        render_futures = []
+        comps_count = len(self.groups)
+        comps_groups = []
+        for index, group_entry in enumerate(self.groups + self.letter_groups):
+            (group_name, group_description, group_file, pkg_list) = group_entry
 
             group_filler = {
                     'name': group_name,
@@ -368,10 +454,9 @@ class RepoView:
                     'filename': group_file
             }
 
-            packages = self.proc_packages(
-                    self.repo_filler,
-                    group_filler,
-                    sorted(pkg_list)
+            (packages, pkg_pages) = self.proc_packages(
+                    sorted(pkg_list),
+                    write_pages=index >= comps_count
             )
 
             group_filler['packages'] = packages
@@ -379,33 +464,48 @@ class RepoView:
             # empty groups are ignored
             if not packages:
                 self.sout(f"Group {group_filler['name']} is empty")
-                del self.groups[counter]
                 continue
 
-            counter += 1
+            if index < comps_count:
+                comps_groups.append(group_entry)
             self.sout(f'Writing group {group_filler["name"]}')
-            output_file = os.path.join(self.outdir, group_filler['filename'])
-            with open(output_file, "w+") as of:
-                of.write(self.group_template.render(
-                    repo_data=self.repo_filler,
-                    group_data=group_filler
+            render_futures.append(render_pool.submit(
+                write_group,
+                self.tmpldir,
+                self._outprefix,
+                self.repo_filler,
+                group_filler
+            ))
+
+            # package pages only need to link back to the group, and are
+            # split into batches so large letter groups spread over workers
+            pkg_group = {
+                    'name': group_name,
+                    'filename': group_file
+            }
+            for start in range(0, len(pkg_pages), RENDER_BATCH):
+                render_futures.append(render_pool.submit(
+                    write_packages,
+                    self.tmpldir,
+                    self._outprefix,
+                    self.repo_filler,
+                    pkg_group,
+                    pkg_pages[start:start + RENDER_BATCH]
                 ))
-                of.close()
 
+        self.groups = comps_groups
+        self.wait_renders(render_futures)
+        render_pool.shutdown()
 
-    def proc_packages(self, repo_data, group_data, pkg_list):
+    def proc_packages(self, pkg_list, write_pages=True):
         """
-        Process package data
+        Process package data. Returns the package listing of a group and the
+        package data of the pages to write for it, if any.
         """
         pkgtups = []
-        written = {}
+        pkg_pages = []
 
         for pkg in pkg_list:
-            pkg_file = ezname(FILE_PKG % pkg)
-            if pkg in written.keys():
-                pkgtups.append(written[pkg])
-                continue
-
             pkg_data = self.get_package_data(pkg)
 
             # This shouldn't happen, but sometimes groups in comps
@@ -413,22 +513,15 @@ class RepoView:
             if pkg_data is None:
                 continue
 
-            pkgtup = (pkg, pkg_file, pkg_data['summary'])
-            pkgtups.append(pkgtup)
-            self.sout(f'Writing package {pkg} to {pkg_file}')
-            self.package_template.group_data = group_data
-            self.package_template.pkg_data = pkg_data
-            output_file = os.path.join(self.outdir, pkg_file)
-            with open(output_file, "w+") as of:
-                of.write(self.package_template.render(
-                    repo_data=repo_data,
-                    group_data=group_data,
-                    pkg_data=pkg_data
-                 ))
-                of.close()
-
-            written[pkg] = pkgtup
-        return pkgtups
+            pkg_file = pkg_data['filename']
+            pkgtups.append((pkg, pkg_file, pkg_data['summary']))
+            if not write_pages:
+                continue
+
+            self.sout(f'Writing package {pkg} to {pkg_file}', batched=True)
+            pkg_pages.append(pkg_data)
+            self._pkg_cache.pop(pkg, None)
+        return (pkgtups, pkg_pages)
 
     def proc_latest(self, pkglist):
         """
@@ -436,7 +529,7 @@ class RepoView:
         """
         tuplist = []
         for pkg in pkglist:
-            filename = ezname(FILE_PKG % pkg.name)
+            filename = self._pkg_filename[pkg.name]
             tuplist.append((pkg.name, filename, pkg.version, pkg.release, pkg.buildtime))
 
         return tuplist
@@ -446,12 +539,17 @@ class RepoView:
         """
         Returns a dict of package information
         """
-        pkg_query = self.sack_query.filter(name=name)
+        if name in self._pkg_cache:
+            return self._pkg_cache[name]
+
+        if name not in self.pkgs_by_name:
+            return None
+
+        pkg_query = self.pkgs_by_name[name]
         # we only want data from the first finding, in the case of
         # multi-version or multilib. but we also have to account for multiple
         if len(pkg_query) == 1:
-            pkg_info = self._pkg_return(pkg_query[0])
-            versions = [pkg_info]
+            versions = [pkg_query[0]]
         else:
             # for loop against the pkg_query and get the data
             # make sure that we only care about evra.
@@ -463,14 +561,12 @@ class RepoView:
                 tempcheck[(str(vers.epoch), vers.version, vers.release, vers.arch)] = vers
 
             keys = list(tempcheck.keys())
-            keys.sort(
-                    key=cmp_to_key(lambda a, b: lc(a[:3], b[:3])),
-                    reverse=True
-            )
+            ranks = evr_ranks(frozenset(key[:3] for key in keys))
+            keys.sort(key=lambda key: ranks[key[:3]], reverse=True)
             for key in keys:
-                versions.append(self._pkg_return(tempcheck[key]))
+                versions.append(tempcheck[key])
 
-        pkg_file = ezname(FILE_PKG % name)
+        pkg_file = self._pkg_filename[name]
         pkg_data = {
                 'name':         name,
                 'filename':     pkg_file,
@@ -483,10 +579,10 @@ class RepoView:
                 'rpms':         []
         }
 
-        for data in versions:
+        for index, pkg in enumerate(versions):
             (name, epoch, version, release, arch, summary, description, url,
              buildtime, rpmlicense, sourcerpm, size, location, remote_location,
-             vendor, changelogs, filelist) = data
+             vendor) = self._pkg_return_meta(pkg)
             # we have to check this because if we have multiple
             # versions/packages we want to make sure we don't keep adding data
             # that's already there
@@ -500,19 +596,24 @@ class RepoView:
 
             size = human_size(size)
 
-            # changelog stuff
-            if changelogs is not None:
-                changelog_list = changelogs.copy()
-            else:
-                changelog_list = []
-            for meta in changelog_list[:2]:
+            # changelog stuff. changelogs and file lists are only gathered for
+            # the newest package, they are expensive and mostly the same for
+            # the rest.
+            changelog_list = None
+            filelist = None
+            if index == 0:
+                (changelogs, filelist) = self._pkg_return_heavy(pkg)
+                if changelogs is not None:
+                    changelog_list = changelogs.copy()
+                else:
+                    changelog_list = []
+            for meta in (changelog_list or [])[:2]:
                 author = meta['author']
                 try:
                     author = author[:author.index('<')].strip()
                 except ValueError:
                     pass
                 meta['author'] = author
-                meta['text'].replace("\n", "<br />\n")
 
             pkg_data['rpms'].append((
                     epoch,
@@ -527,6 +628,7 @@ class RepoView:
                     filelist
             ))
 
+        self._pkg_cache[pkg_data['name']] = pkg_data
         return pkg_data
 
     def get_group_data(self, groups):
@@ -560,14 +662,9 @@ class RepoView:
         for group in letters:
             pkggroup = f'Letter {group}'
             description = f'Packages beginning with the letter "{group}"'
-            filtered = self.sack_query.filter(name__glob=f'{group}*')
-            pkgs = []
-            for filt in filtered:
-                pkgs.append(filt.name)
-
-            # There is a chance that a package may be multi-lib or may have
-            # multiple versions of itself in a repo
-            uniqpkgs = uniqlist(pkgs)
+            # The buckets are built from unique names, so multi-lib or
+            # multiple versions of a package are already accounted for
+            uniqpkgs = sorted(self.letter_buckets[group])
             group_filename = ezname(FILE_GRP % group)
             list_of_list.append([pkggroup,
                                  description,
@@ -578,36 +675,77 @@ class RepoView:
 
     def setup_output(self):
         """
-        Setup the output directory
+        Setup the build directory that pages are written to. This runs in the
+        background while dnf loads, so it also removes the output tree that
+        the previous run moved aside, and any build directory left over from
+        an interrupted run.
         """
-        if os.access(self.outdir, os.R_OK):
-            shutil.rmtree(self.outdir)
-        else:
-            os.mkdir(self.outdir, 0o755)
+        for leftover in (self._olddir, self._builddir):
+            if os.path.isdir(leftover):
+                shutil.rmtree(leftover)
+        os.mkdir(self._builddir, 0o755)
 
         # Layouts can be created - This is a carry over from the former repoview
         self.sout('Checking if we have a layout to copy')
         layout_src  = os.path.join(self.tmpldir, 'layout')
-        layout_dest = os.path.join(self.outdir, 'layout')
-        if os.path.isdir(layout_src) and not os.access(layout_dest, os.R_OK):
+        layout_dest = os.path.join(self._builddir, 'layout')
+        if os.path.isdir(layout_src):
             self.sout('Copying layout')
             shutil.copytree(layout_src, layout_dest)
 
-    def sout(self, msg):
+    def publish_output(self):
         """
-        Send a message to stdout
+        Swap the build directory into place as the output directory. The
+        previous output directory is moved aside and left there, it is
+        removed by setup_output on the next run so its removal overlaps that
+        run's dnf load instead of this run's finish.
         """
-        if not self.quiet:
-            sys.stdout.write(msg + '\n')
+        if os.path.isdir(self.outdir):
+            os.rename(self.outdir, self._olddir)
+        os.rename(self._builddir, self.outdir)
+
+    def wait_renders(self, futures):
+        """
+        Waits for all queued group renders to finish. Write errors are fatal.
+        """
+        done, _ = wait(futures)
+        for future in done:
+            exc = future.exception()
+            if exc is not None:
+                self.serr(f'Could not write group pages: {exc}')
+                sys.exit(1)
+
+    def sout(self, msg, batched=False):
+        """
+        Send a message to stdout. Batched messages are buffered and written
+        out together, which is meant for per package messages.
+        """
+        if self.quiet:
+            return
+        with self._sout_lock:
+            self._sout_buf.append(msg + '\n')
+            if not batched or len(self._sout_buf) >= SOUT_BATCH:
+                self.flush_sout()
+
+    def flush_sout(self):
+        """
+        Write out any buffered stdout messages
+        """
+        with self._sout_lock:
+            if self._sout_buf:
+                sys.stdout.write(''.join(self._sout_buf))
+                sys.stdout.flush()
+                self._sout_buf = []
 
     def serr(self, msg):
         """
         Send a message to stderr. Pierces quiet mode.
         """
+        self.flush_sout()
         sys.stderr.write(msg + '\n')
 
     @staticmethod
-    def _pkg_return(data):
+    def _pkg_return_meta(data):
         """
         Returns a tuple of needed package data. This func is to avoid
         duplicating the work in proc packages
@@ -627,12 +765,18 @@ class RepoView:
                 data.size,
                 data.location,
                 data.remote_location(),
-                data.vendor,
-                data.changelogs,
-                data.files
+                data.vendor
         )
         return ordered_data
 
+    @staticmethod
+    def _pkg_return_heavy(data):
+        """
+        Returns a tuple of the changelogs and files of a package. These are
+        kept apart from the rest as they are expensive to gather.
+        """
+        return (data.changelogs, data.files)
+
 def main(options):
     """
     Start up the repoview script